@@ -28,12 +28,19 @@ To do:
 import re
 from pathlib import Path
 from argparse import ArgumentParser 
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import seaborn as sns
 from pandas.plotting import register_matplotlib_converters
 
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:
+    pyarrow = None
+
 sns.set(style='white')
 sns.set_context('notebook') 
 register_matplotlib_converters()
@@ -43,19 +50,75 @@ register_matplotlib_converters()
 grace_minutes = 2
 min_duration = 0.9
 max_unanswered = 1
+participation_time_format = '%m/%d/%Y %I:%M:%S %p'   # join/leave times in Zoom reports
+cache_inputs = False  # cache parsed input files as feather files (needs pyarrow)
+cache_version = 1     # part of every cache key
+
+# nickname in parentheses after a name, like 'Ana Perez (she/her)'
+nickname_re = re.compile(r'\s*\([^)]*\)')
+
+# chat line, like '10:15:02\t From  Ana Perez  to  Glenn Bruns(Direct Message) : 42';
+# groups are time, sender name, and recipient (empty for old-style public chats,
+# 'Everyone' for newer ones); a chat is private if its recipient contains 'Direct'
+chat_line_re = re.compile(r'^(\d\S*)[ \t]+From[ \t]+(.*?)(?:[ \t]+to[ \t]+(.*?))? : .*$', re.MULTILINE)
+
+def cache_key(path, parser, args):
+    """ Return a key identifying the result of parser(path, *args).
+    
+    The key changes if the file is replaced or modified, or if the parser,
+    its arguments, or the settings used in parsing change.  Increase
+    cache_version when a change to a parser changes its output. """
+    
+    stat = Path(path).stat()
+    return repr((cache_version, parser.__module__, parser.__qualname__, args,
+                 stat.st_mtime_ns, stat.st_size,
+                 nickname_re.pattern, chat_line_re.pattern, participation_time_format))
+
+
+def cached_read(path, parser, *args):
+    """ Return parser(path, *args), reading it instead from a feather file
+        next to path if that file was written for the same file contents,
+        parser, arguments, and settings. """
+    
+    # no caching without pyarrow, or if there is no file (as for a missing chat file)
+    if not cache_inputs or pyarrow is None or not path:
+        return parser(path, *args)
+    
+    cache = Path(str(path) + '.feather')
+    key = cache_key(path, parser, args).encode('utf8')
+    if cache.exists():
+        try:
+            table = pyarrow.feather.read_table(cache)
+            if (table.schema.metadata or {}).get(b'cache_key') == key:
+                return table.to_pandas()
+        except (OSError, pyarrow.ArrowException) as e:
+            print('warning: could not read cache file {}: {}'.format(cache, e))
+    
+    df = parser(path, *args)
+    try:
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {}, cache_key=key)
+        pyarrow.feather.write_feather(table.replace_schema_metadata(metadata), cache)
+    except (OSError, pyarrow.ArrowException) as e:
+        print('warning: could not write cache file {}: {}'.format(cache, e))
+    return df
+
 
 def read_participation(participation_file):
     """ Return data frame with meeting join/leave data. """
     
-    df = pd.read_csv(participation_file)
-    df.columns = ['name', 'email', 'join', 'leave', 'duration', 'guest']
+    # email and guest columns are not used
+    df = pd.read_csv(participation_file, header=0, 
+                     names=['name', 'email', 'join', 'leave', 'duration', 'guest'],
+                     usecols=['name', 'join', 'leave', 'duration'],
+                     dtype={'name': str, 'join': str, 'leave': str, 'duration': 'float64'})
     
     # remove part of name in parentheses
-    df['name'] = df['name'].str.replace(' \(.*\)', '')
+    df['name'] = df['name'].str.replace(nickname_re, '', regex=True)
     
     # convert join, leave times to Pandas timestamps
-    df['join']  = pd.to_datetime(df['join'])
-    df['leave'] = pd.to_datetime(df['leave'])
+    df['join']  = pd.to_datetime(df['join'],  format=participation_time_format, cache=True)
+    df['leave'] = pd.to_datetime(df['leave'], format=participation_time_format, cache=True)
     
     return df
 
@@ -64,26 +127,21 @@ def read_chat(chat_file, meeting_date):
     """ Return data frame with user name and chat time. """
     
     if chat_file == "":
-        return pd.DataFrame({'name':[], 'date':[], 'private':[]})
+        return pd.DataFrame({'name': pd.Series(dtype=object), 
+                             'date': pd.Series(dtype='datetime64[ns]'), 
+                             'private': pd.Series(dtype=bool)})
     
-    tbl = []
-    for line in open(chat_file, encoding='utf8'):
-        # validate the line
-        if not (" " in line and " : " in line and line[:1].isnumeric()):
-            continue
-        
-        private = 'Direct' in line
-        time = line.split()[0]
-        date = meeting_date + ' ' + time
-        if private:
-            name = (line.split(' From ')[1].split(' to ')[0]).strip()
-        else:
-            name = (line.split(' From ')[1].split(':')[0]).strip()
-        name = re.sub(' \(.*\)', '', name)  # remove nickname
-        tbl.append([name, date, private])
-        
-    df = pd.DataFrame(tbl, columns=['name', 'date', 'private'])
-    df['date'] = pd.to_datetime(df['date'])
+    text = Path(chat_file).read_text(encoding='utf8', errors='replace')
+    
+    # parse all chat lines at once; lines that are not chats don't match
+    rows = chat_line_re.findall(text)
+    cols = zip(*rows) if rows else [(), (), ()]
+    time, name, to = (pd.Series(col, dtype=object) for col in cols)
+    
+    name = name.str.strip().str.replace(nickname_re, '', regex=True)  # remove nickname
+    df = pd.DataFrame({'name': name, 
+                       'date': pd.Timestamp(meeting_date) + pd.to_timedelta(time), 
+                       'private': to.str.contains('Direct', regex=False).astype(bool)})
     
     return df
 
@@ -91,17 +149,35 @@ def read_chat(chat_file, meeting_date):
 def read_roster(roster_file):
     """ Return student names and alias dictionary from roster file. """
     
-    df = pd.read_csv(roster_file)
+    df = cached_read(roster_file, pd.read_csv)
     names = df['First name']+' '+df['Last name'] 
     
-    df['alias'].fillna('', inplace=True)  # '' or NA indicates no alias
-    alias = df['alias']
-    mask = (df['alias'] != '')
+    alias = df['alias'].fillna('')  # '' or NA indicates no alias
+    mask = (alias != '')
     aliases = dict(zip(alias[mask], names[mask]))
 
     return names, aliases    
 
 
+def sweep_periods(counts, k):
+    """ Return start positions, end positions, and maximum counts of the
+        periods in a sequence of rolling window counts that have a count
+        greater than k. """
+    
+    # a count of one starts a new period; a count > 1 extends the
+    # current period, so each period ends just before the next start
+    starts = np.flatnonzero(counts == 1)
+    ends = np.append(starts[1:], len(counts)) - 1
+    if len(starts) > 0:
+        max_counts = np.maximum.reduceat(counts, starts)
+    else:
+        max_counts = counts[:0]
+    
+    # keep only periods in which enough students answered
+    keep = max_counts > k
+    return starts[keep], ends[keep], max_counts[keep]
+
+
 def find_question_periods(chat, k=10, window_size='45s'):
     """ From chat data, find periods in which students are answering questions. 
     
@@ -113,64 +189,50 @@ def find_question_periods(chat, k=10, window_size='45s'):
     slightly smaller one would work just as well.  The issue is with
     back-to-back questions.
         
-    Note that the Pandas rolling window algorithm uses the right-edge
-    time as the time for a window, and does not record zero counts.
-    So the window moves forward in time until it captures the first
-    event, then records a count of one.  It moves right again until
-    it captures the next even, and then records a count of how many
-    events are now in the window (which would be 1 or 2).  """
-    
-    cp = chat[chat['private'] == True]
-    cp.set_index('date', inplace=True)
-    cp.sort_index(inplace=True)    
-    
-    # note that the times in cp are times for the right edges of
-    # the window
-    cpr = cp.rolling(window_size).sum()    
+    Window counts are computed as in the Pandas rolling window algorithm,
+    which uses the right-edge time as the time for a window, and does
+    not record zero counts.  So the window moves forward in time until
+    it captures the first event, then records a count of one.  It moves
+    right again until it captures the next even, and then records a count
+    of how many events are now in the window (which would be 1 or 2).  """
+    
+    # times of private chats, in order
+    private = chat['private'].to_numpy(dtype=bool)
+    times = np.sort(chat['date'].to_numpy(dtype='datetime64[ns]')[private])
+    
+    # count the private chats in the window whose right edge is at
+    # each private chat; lo is the first chat inside the window
+    window = pd.Timedelta(window_size).to_timedelta64()
+    lo = np.searchsorted(times, times - window, side='right')
+    counts = np.arange(len(times)) - lo + 1
     
     # this can be used to plot the question answering activity
-    # plt.plot(cpr)
-    
-    max_count = 0
-    start_time = None
-    end_time = None
-    periods = []
-    for i in range(cpr.shape[0]):
-        t = cpr.index[i]
-        count = cpr['private'][i]
-        if count == 1:
-            # wrap up previous period, if any
-            if max_count > k:
-                periods.append([start_time, end_time, max_count])
-                
-            # start new period
-            start_time = t
-            end_time = None
-            max_count = 1
-        else:
-            # count > 1; extend current period
-            end_time = t
-            if count > max_count:
-                max_count = count
-    
-    # wrap up previous period, if any
-    if max_count > k:
-        periods.append([start_time, end_time, max_count])
-
-    df = pd.DataFrame(periods)
-    if df.size > 0:
-        df.columns = ['start', 'end', 'max_count']  
+    # plt.plot(times, counts)
+    
+    starts, ends, max_counts = sweep_periods(counts, k)
+    df = pd.DataFrame({'start': times[starts], 
+                       'end': times[ends], 
+                       'max_count': max_counts})
 
     return df    
 
 
-def students_without_answer(chat, start, end, names):
-    """ Return a list of students who did not send a private chat
-        between times start and end. """
-        
-    answered = chat[(chat['date'] >= start) & (chat['date'] <= end)]['name'].unique()
-    unanswered = list(set(names) - set(answered))
-    return unanswered
+def students_without_answer(chat, periods, names):
+    """ Return, for each question-answering period, an array of students
+        who did not send a private chat between its start and end times. """
+    
+    if periods.shape[0] == 0:
+        return []
+    
+    # chats sent during each period form a slice of the time-sorted chat data
+    chat = chat.sort_values('date')
+    dates = chat['date'].to_numpy()
+    chat_names = chat['name'].to_numpy()
+    lo = np.searchsorted(dates, periods['start'].to_numpy())
+    hi = np.searchsorted(dates, periods['end'].to_numpy(), side='right')
+    
+    names = np.asarray(names)
+    return [names[~np.isin(names, chat_names[i:j])] for i, j in zip(lo, hi)]
 
 
 def make_attendance_plot(zoom_dir, course, meeting_date, classtime, outfile_name='attendance.png'):
@@ -218,16 +280,22 @@ def make_attendance_plot(zoom_dir, course, meeting_date, classtime, outfile_name
     # get lecture start and end times
     start_time = pd.to_datetime(meeting_date+' '+classtime[0])
     end_time   = pd.to_datetime(meeting_date+' '+classtime[1])
-    class_len_mins = pd.Timedelta(end_time - start_time)/pd.Timedelta(minutes=1)
+    class_len_mins = (end_time - start_time).total_seconds()/60
     
     # read roster, participation (join/leave), and chat data
     roster, aliases = read_roster(roster_file)
-    df = read_participation(participation_file)
-    chat = read_chat(chat_file, meeting_date)
+    df = cached_read(participation_file, read_participation)
+    chat = cached_read(chat_file, read_chat, meeting_date)
+    
+    # a student listed more than once would get several summary rows
+    duplicates = list(roster[roster.duplicated()].unique())
+    if len(duplicates) > 0:
+        print('warning: names listed more than once in {}: {}'.format(roster_file, duplicates))
+        roster = roster.drop_duplicates().reset_index(drop=True)
     
     # remove any aliases
-    df['name'].replace(aliases, inplace=True)
-    chat['name'].replace(aliases, inplace=True)
+    df['name'] = df['name'].map(aliases).fillna(df['name'])
+    chat['name'] = chat['name'].map(aliases).fillna(chat['name'])
     
     # report unknown names
     # is any of these besides instructors and TA, need to
@@ -235,6 +303,16 @@ def make_attendance_plot(zoom_dir, course, meeting_date, classtime, outfile_name
     unknown_names = list(set(df['name']) - set(roster))
     print('Unknown names: {}'.format(unknown_names))
     
+    # use one categorical type for names in all data frames, so that
+    # grouping and joining on names uses integer codes
+    # (blank roster rows and blank participant names have no name)
+    roster = roster.dropna().reset_index(drop=True)
+    all_names = pd.concat([roster, df['name'], chat['name']]).dropna().unique()
+    name_dtype = pd.CategoricalDtype(sorted(all_names))
+    roster = roster.astype(name_dtype)
+    df['name'] = df['name'].astype(name_dtype)
+    chat['name'] = chat['name'].astype(name_dtype)
+    
     # create data frame of names, each with a unique ID
     names = pd.DataFrame({'name': roster})
     names.sort_values(['name'], inplace=True, ascending=False)
@@ -243,44 +321,28 @@ def make_attendance_plot(zoom_dir, course, meeting_date, classtime, outfile_name
     # add student IDs to join/leave data
     df = df.merge(names, on='name')
     
-    # create summary dataframe; add IDs
-    summary = pd.DataFrame({'name': roster})
-    summary = summary.merge(names, on='name')
+    # students who joined the meeting
+    participation_names = df['name'].unique()
     
     #
     # number of minutes in class
     #
     
     # for student, compute total duration
-    duration_by_student = df.groupby('name')['duration'].sum().reset_index()
+    duration_by_student = df.groupby('name', observed=True)['duration'].sum().to_frame()
     duration_by_student['frac_duration'] = duration_by_student['duration']/class_len_mins
     
-    # add duration info to summary
-    summary = summary.merge(duration_by_student, how='left', on='name')
-    summary.fillna(0)
-    
     #
     # is late to class?
     #
     
     # for each student who joined, get earliest join time
-    late_time = start_time + pd.to_timedelta(grace_minutes, unit='minute')
-    first_join = df.groupby('name')['join'].min()
-    first_join = first_join.reset_index()
-    first_join.columns = ['name', 'first_join']
+    late_time = start_time + pd.Timedelta(minutes=grace_minutes)
+    first_join = df.groupby('name', observed=True)['join'].min().to_frame('first_join')
     first_join['is_late'] = first_join['first_join'] > late_time
     
-    # add is_late to join/leave and summary
-    df = df.merge(first_join[['name', 'is_late']], how='left', on='name')
-    summary = summary.merge(first_join[['name', 'is_late']], how='left', on='name')
-    
-    #
-    # joined meeting at all?
-    #
-    
-    # add a column to summary about whether joined
-    summary['joined'] = ~summary['is_late'].isna()
-    summary['is_late'].fillna(False, inplace=True)
+    # add is_late to join/leave data
+    df['is_late'] = df['name'].map(first_join['is_late']).astype(bool)
     
     #
     # answered questions?
@@ -290,15 +352,30 @@ def make_attendance_plot(zoom_dir, course, meeting_date, classtime, outfile_name
     all_unanswered = []
     periods = find_question_periods(chat)
     num_questions = periods.shape[0]
-    for i in range(num_questions):
-        p = periods.iloc[i]
-        all_unanswered.extend(students_without_answer(chat, p['start'], p['end'], df['name'].unique()))
-    unanswered_counts = pd.Series(all_unanswered).value_counts()
-    unanswered_counts = unanswered_counts.rename_axis('name').reset_index(name='num_unanswered')
-    unanswered_counts['fraction_unanswered'] = unanswered_counts['num_unanswered']/num_questions
-    
-    # add columns to summary about missed questions
-    summary = summary.merge(unanswered_counts, how='left', on='name')
+    unanswered_by_period = students_without_answer(chat, periods, participation_names)
+    for unanswered in unanswered_by_period:
+        all_unanswered.extend(unanswered)
+    unanswered_counts = pd.Series(all_unanswered, dtype=name_dtype).value_counts()
+    unanswered_counts = unanswered_counts[unanswered_counts > 0]  # drop unused categories
+    unanswered_counts = unanswered_counts.rename_axis('name').rename('num_unanswered').to_frame()
+    if num_questions > 0:
+        unanswered_counts['fraction_unanswered'] = unanswered_counts['num_unanswered']/num_questions
+    else:
+        unanswered_counts['fraction_unanswered'] = 0.0
+    
+    #
+    # create summary dataframe, indexed by name
+    #
+    
+    # start from student IDs in roster order; add duration, lateness,
+    # and missed questions in a single join
+    summary = names.set_index('name').loc[roster]
+    summary = summary.join([duration_by_student, first_join[['is_late']], unanswered_counts], 
+                           how='left')
+    
+    # students who never joined have no first join time
+    summary.insert(summary.columns.get_loc('is_late')+1, 'joined', summary['is_late'].notna())
+    summary['is_late'] = summary['is_late'].fillna(False).astype(bool)
     summary.fillna(0, inplace=True)
     
     #
@@ -307,20 +384,22 @@ def make_attendance_plot(zoom_dir, course, meeting_date, classtime, outfile_name
     
     # compute is_absent column in summary
     summary['is_absent'] = summary['is_late'] | ~summary['joined'] | (summary['num_unanswered'] > max_unanswered) | (summary['frac_duration'] < min_duration)
-    df = df.merge(summary[['name', 'is_absent']], on='name')
+    df['is_absent'] = df['name'].map(summary['is_absent']).astype(bool)
+    summary.reset_index(inplace=True)
+    summary['name'] = summary['name'].astype(object)  # return plain names, not categories
     
     #
     # create the plot and write to file
     #
     
-    generate_plot(course, df, names, summary, chat, periods, 
+    generate_plot(course, df, names, summary, periods, unanswered_by_period, 
                   start_time, end_time, late_time, 
                   meeting_dir / outfile_name)
     
     return summary
 
 
-def generate_plot(course, df, names, summary, chat, periods, start_time, end_time, late_time, outfile):
+def generate_plot(course, df, names, summary, periods, unanswered_by_period, start_time, end_time, late_time, outfile):
     """ Plot attendance and save plot to file.
         green lines: start/end of class
         yellow line: end of grace period after start of class
@@ -341,11 +420,11 @@ def generate_plot(course, df, names, summary, chat, periods, start_time, end_tim
     ax[1].hlines(y=df_late['id'], xmin=df_late['join'], xmax=df_late['leave'], color='red')
     
     # plot names
-    for i in range(names.shape[0]):
-        ax[0].annotate(names.iloc[i]['name'], (0, names.iloc[i]['id']-0.2), annotation_clip=True)
+    for name, y in zip(names['name'], names['id']):
+        ax[0].annotate(name, (0, y-0.2), annotation_clip=True)
     absent = summary[summary['is_absent']]
-    for i in range(absent.shape[0]):
-        ax[0].text(0, absent.iloc[i]['id']-0.2, absent.iloc[i]['name'], color='red')
+    for name, y in zip(absent['name'], absent['id']):
+        ax[0].text(0, y-0.2, name, color='red')
     
     # title and date format on right
     ax[1].set_title('{} Attendance, {}/{}'.format(course, start_time.month, start_time.day))
@@ -360,25 +439,25 @@ def generate_plot(course, df, names, summary, chat, periods, start_time, end_tim
     for spine in ['left', 'right', 'top', 'bottom']:
         ax[0].spines[spine].set_visible(False)
         
-    # plot questions intervals and students who didn't answer
-    for i in range(periods.shape[0]):
-        p = periods.iloc[i]
-        unanswered = students_without_answer(chat, p['start'], p['end'], df['name'].unique())
-    
-        ax[1].vlines(x=p['start'], ymin=0, ymax=len(names)-1, color='dodgerblue')
-        ax[1].vlines(x=p['end'],   ymin=0, ymax=len(names)-1, color='dodgerblue')
+    # plot questions intervals and students who didn't answer, if
+    # there were any questions
+    if not periods.empty:
+        ax[1].vlines(x=periods['start'], ymin=0, ymax=len(names)-1, color='dodgerblue')
+        ax[1].vlines(x=periods['end'],   ymin=0, ymax=len(names)-1, color='dodgerblue')
         
-        # plot unanswered questions
-        midp = p['start'] + (p['end']-p['start'])/2
-    
-        df1 = pd.DataFrame({'name': unanswered})
-        df1 = df1.merge(names)
-        for j in range(df1.shape[0]):
-            ax[1].plot(midp, df1.iloc[j]['id'], 'or')
+        # plot unanswered questions at the middle of each period
+        midpoints = periods['start'] + (periods['end']-periods['start'])/2
+        xs, ys = [], []
+        for midp, unanswered in zip(midpoints, unanswered_by_period):
+            ids = names.loc[names['name'].isin(unanswered), 'id']
+            xs.extend([midp]*len(ids))
+            ys.extend(ids)
+        ax[1].scatter(xs, ys, color='r', marker='o', zorder=2)
     
     fig.savefig(outfile)
 
 def main():
+    global cache_inputs
     
     # parse command-line arguments
     parser = ArgumentParser(description="Generate a participation plot")
@@ -387,7 +466,10 @@ def main():
     parser.add_argument("meeting_date",help="date of the course meeting")
     parser.add_argument("start_time",  help="course start time")
     parser.add_argument("end_time",    help="course end time")
+    parser.add_argument("--cache",     action="store_true",
+                        help="cache parsed Zoom and roster files next to them as .feather files (needs pyarrow)")
     args = parser.parse_args()
+    cache_inputs = args.cache
     
     make_attendance_plot(args.zoom_dir, args.course, 
                  args.meeting_date, [args.start_time, args.end_time])